@@ -1,103 +1,225 @@
+import eventlet
+eventlet.monkey_patch() # Must run before anything else imports socket/select/threading
+from eventlet.hubs import trampoline # Parks a green thread until an fd is readable
+from eventlet.patcher import original
+from eventlet import tpool # Native threads for blocking calls
+
+import atexit
+import hashlib
+import logging
+import logging.handlers
 import os
-import pexpect # For interacting with the gamdl CLI
-from flask import Flask, render_template, request # request is used by socketio for sid
-from flask_socketio import SocketIO, emit, join_room, leave_room # For WebSocket communication
+import queue
+import signal
+import threading
+import time
+import weakref
+from ptyprocess import PtyProcess # Runs the gamdl CLI in a pseudo-terminal
+from flask import Flask, Response, render_template, request # request is used by socketio for sid
+from flask_socketio import SocketIO, emit # For WebSocket communication
 # dotenv is no longer used for these paths in Docker context
-import threading # For running pexpect reads in a non-blocking way
+
+# Log records are queued and written to stderr by a listener thread, so logging from the
+# request handlers and output readers never waits on the terminal.
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop) # Drain anything still queued on shutdown
+logger = logging.getLogger('gamdl')
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.setLevel(logging.INFO)
+logger.propagate = False # Already handled above; don't also pass records to the root logger
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24) # Necessary for Flask-SocketIO session management
-socketio = SocketIO(app, async_mode='threading') # Using threading for async operations
+socketio = SocketIO(app, async_mode='eventlet') # Green threads multiplexed on one event loop; enables WebSocket transport
 
 # Configuration paths are fixed for Docker.
 # Users should use volume mounts in docker-compose.yml to provide these.
 GAMDL_COOKIES_PATH = "/app/config/cookies.txt"
 GAMDL_OUTPUT_PATH = "/app/music"
 
-# Dictionary to store child Pexpect processes, keyed by session ID (request.sid)
-child_processes = {}
+# Arguments shared by every gamdl run, built once at startup.
+GAMDL_BASE_ARGS = (
+    '--cookies-path', GAMDL_COOKIES_PATH,
+    '--output-path', GAMDL_OUTPUT_PATH,
+    '--mp4decrypt-path', '/usr/local/bin/mp4decrypt', # Path for Bento4 built from source
+)
+# Set terminal dimensions for the pty
+# This might help gamdl (or its underlying libraries) better detect terminal capabilities.
+# Dimensions are (rows, cols).
+GAMDL_DIMENSIONS = (24, 80) # A common default terminal size
+
+# gamdl output is coalesced into larger Socket.IO messages instead of one emit per read.
+# A batch is sent once it reaches OUTPUT_FLUSH_SIZE bytes or has waited OUTPUT_FLUSH_INTERVAL seconds.
+OUTPUT_FLUSH_SIZE = 16384
+OUTPUT_FLUSH_INTERVAL = 0.03
+# Seconds without output before the reader checks whether gamdl is still alive
+LIVENESS_CHECK_IDLE = 2.0
+
+# Unpatched os.read: the reader waits for readability itself, so the green version's extra wait is redundant.
+_os_read = original('os').read
+
+# Cap on gamdl processes running at once across all sessions; further requests are turned away
+GAMDL_MAX_CONCURRENT = int(os.environ.get('GAMDL_MAX_CONCURRENT', '4'))
+gamdl_slots = threading.BoundedSemaphore(GAMDL_MAX_CONCURRENT)
+
+# Dictionary to store child PtyProcess processes, keyed by session ID (request.sid)
+# Entries drop out by themselves once nothing (e.g. the output reader) references the process any more.
+# No locks are needed: everything runs as green threads on one event loop, which only switches
+# between them at I/O, so each check-then-update below is atomic as long as it doesn't yield.
+child_processes = weakref.WeakValueDictionary()
+# SIDs whose gamdl spawn is in flight (the spawn yields to the event loop while it runs)
+starting_sids = set()
+
+# The main page has no server-side dynamic content (that is handled by WebSockets),
+# so it is rendered once at startup and served from memory.
+with app.app_context():
+    INDEX_HTML = render_template('index.html').encode('utf-8')
+INDEX_ETAG = hashlib.sha1(INDEX_HTML).hexdigest()
 
 @app.route('/', methods=['GET']) # Explicitly state GET, though it's default
 def index():
-    # The main page is now simpler, dynamic content is handled by WebSockets
     # This route only supports GET requests.
-    return render_template('index.html')
+    response = Response(INDEX_HTML, mimetype='text/html')
+    response.set_etag(INDEX_ETAG)
+    response.cache_control.no_cache = True # Always revalidate; unchanged pages get a 304 via the ETag
+    return response.make_conditional(request)
 
 # Helper function to read output from gamdl process
 def read_gamdl_output(sid, child_process):
     """
     Reads output from the gamdl process and emits it to the client via WebSockets.
-    This function is intended to be run in a background thread.
+    This function is intended to be run as a Socket.IO background task (a green thread).
     """
-    print(f"Starting gamdl output reader for SID {sid}.")
+    logger.info(f"Starting gamdl output reader for SID {sid}.")
+    fd = child_process.fd
+    os.set_blocking(fd, False) # A spurious wakeup must not stall the event loop in read()
+    pending = bytearray() # Output read but not yet emitted
+    last_flush = time.monotonic()
+    last_activity = time.monotonic() # When the pty last produced output, or liveness was last checked
+
+    def flush_output():
+        nonlocal last_flush
+        if pending:
+            # Hot path: go straight to the python-socketio server, addressing the client by SID.
+            # Raw bytes go out as a binary frame; Xterm.js decodes the UTF-8 itself
+            # (including characters split across frames), so there is no decode/JSON step here.
+            socketio.server.emit('gamdl_output', bytes(pending), to=sid)
+            pending.clear()
+        last_flush = time.monotonic()
+
     try:
         while True:
             try:
-                # Read output with a small timeout to avoid blocking indefinitely
-                # pexpect.spawn was called with encoding='utf-8', so read_nonblocking returns a string.
-                output_str = child_process.read_nonblocking(size=1024, timeout=0.2) # Small timeout
-                if output_str: # output_str is already a string
-                    socketio.emit('gamdl_output', {'data': output_str}, room=sid)
-            except pexpect.TIMEOUT:
-                # This is expected if there's no output. Check if process is alive.
-                if not child_process.isalive():
-                    socketio.emit('info_message', {'message': 'gamdl process appears to have exited.'}, room=sid)
-                    print(f"Gamdl process for SID {sid} exited (not alive).")
-                    break
-                continue # Continue loop, waiting for more output
-            except pexpect.EOF:
-                # End Of File means the process has terminated.
-                socketio.emit('info_message', {'message': 'gamdl process finished (EOF).'}, room=sid)
-                print(f"Gamdl process for SID {sid} finished (EOF).")
-                break # Exit the loop
+                # Sleep in the event loop's epoll set until the pty has bytes (or hangs up),
+                # rather than waking on a short timer to poll for output.
+                # If output is buffered, only wait until that batch is due. Otherwise wake up
+                # once output has been quiet for a while: the pty only hangs up once every process
+                # holding it has exited, so a child of gamdl that outlives it would keep us waiting forever.
+                if pending:
+                    wait = max(0, OUTPUT_FLUSH_INTERVAL - (time.monotonic() - last_flush))
+                else:
+                    wait = max(0, LIVENESS_CHECK_IDLE - (time.monotonic() - last_activity))
+                try:
+                    trampoline(fd, read=True, timeout=wait, timeout_exc=eventlet.Timeout)
+                except eventlet.Timeout:
+                    if pending:
+                        # The batch is due; send what we have.
+                        flush_output()
+                        continue
+                    # No output for a while. Check if process is alive; while output is flowing this
+                    # never runs, sparing the waitpid() syscall behind isalive().
+                    last_activity = time.monotonic()
+                    if not child_process.isalive():
+                        socketio.emit('info_message', {'message': 'gamdl process appears to have exited.'}, room=sid)
+                        logger.info(f"Gamdl process for SID {sid} exited (not alive).")
+                        break
+                    continue # Continue loop, waiting for more output
+                # Read raw bytes straight off the pty fd, bypassing any Python-level file buffering.
+                # A large size lets one call drain a whole burst.
+                try:
+                    output_bytes = _os_read(fd, 65536)
+                except BlockingIOError:
+                    continue # Spurious wakeup with nothing to read
+                except OSError:
+                    # Linux reports EIO on the pty master once the child side has closed.
+                    output_bytes = b''
+
+                if not output_bytes:
+                    # End Of File means the process has terminated.
+                    flush_output()
+                    socketio.emit('info_message', {'message': 'gamdl process finished (EOF).'}, room=sid)
+                    logger.info(f"Gamdl process for SID {sid} finished (EOF).")
+                    break # Exit the loop
+
+                pending += output_bytes
+                last_activity = time.monotonic()
+                if len(pending) >= OUTPUT_FLUSH_SIZE or time.monotonic() - last_flush >= OUTPUT_FLUSH_INTERVAL:
+                    flush_output()
             except Exception as e:
                 # Catch any other exceptions during read
                 error_msg = f"Error reading gamdl output for SID {sid}: {str(e)}"
-                print(error_msg)
+                logger.error(error_msg)
                 socketio.emit('error_message', {'error': error_msg}, room=sid)
                 break # Exit the loop
     finally:
         # Ensure cleanup happens regardless of how the loop exits
-        if child_process.isalive():
-            print(f"Closing pexpect child for SID {sid}.")
-            child_process.close() # Close the connection to the child
-        if sid in child_processes:
-            print(f"Removing SID {sid} from child_processes.")
-            del child_processes[sid] # Remove from active processes
-        # Notify client that the process is fully done and cleaned up
-        socketio.emit('download_complete', {'message': 'Download process and cleanup finished.'}, room=sid)
-        print(f"Gamdl output thread for SID {sid} finished.")
+        try:
+            try:
+                flush_output() # Don't drop output buffered before an error
+            finally:
+                if child_process.isalive():
+                    logger.info(f"Closing pty child for SID {sid}.")
+                    child_process.close() # Close the connection to the child
+            # Notify client that the process is fully done and cleaned up
+            socketio.emit('download_complete', {'message': 'Download process and cleanup finished.'}, room=sid)
+            logger.info(f"Gamdl output thread for SID {sid} finished.")
+        finally:
+            # Only once the old process is gone, so the GAMDL_MAX_CONCURRENT cap holds
+            gamdl_slots.release() # Let the next download start
+
+def force_kill_after(sid, child_process, delay):
+    """
+    SIGKILLs the gamdl process if it is still running after `delay` seconds.
+    This function is intended to be run as a Socket.IO background task.
+    """
+    socketio.sleep(delay)
+    if child_process.isalive():
+        logger.warning(f"gamdl process for SID {sid} ignored SIGTERM, sending SIGKILL.")
+        try:
+            child_process.kill(signal.SIGKILL)
+        except Exception as e:
+            logger.error(f"Error killing process for SID {sid}: {str(e)}")
 
 @socketio.on('connect')
 def handle_connect():
     sid = request.sid
-    join_room(sid) # Each client joins a room identified by their session ID
-    print(f"Client connected: {sid}")
+    # No join_room(sid) needed: Socket.IO already places every client in a room named after its SID
+    logger.info(f"Client connected: {sid}")
     # GAMDL_COOKIES_PATH and GAMDL_OUTPUT_PATH are now hardcoded,
     # so no check is needed here for them being set.
 
 @socketio.on('disconnect')
 def handle_disconnect():
     sid = request.sid
-    print(f"Client disconnected: {sid}")
+    logger.info(f"Client disconnected: {sid}")
+    starting_sids.discard(sid) # Tells an in-flight start_download to abandon its child
     child_process = child_processes.pop(sid, None) # Remove and get process
     if child_process and child_process.isalive():
-        print(f"Terminating gamdl process for SID {sid} due to disconnect.")
+        logger.info(f"Terminating gamdl process for SID {sid} due to disconnect.")
         try:
-            # Attempt graceful shutdown first
-            if child_process.isalive(): child_process.sendeof() # Ctrl+D, might close some interactive prompts
-            socketio.sleep(0.1) # Give a moment for EOF to be processed
-            if child_process.isalive(): child_process.terminate(force=False) # SIGTERM
-            socketio.sleep(0.1) # Give a moment for SIGTERM
-            if child_process.isalive(): child_process.terminate(force=True) # SIGKILL
+            # Ask gamdl to exit and return right away; escalation happens in the background
+            child_process.kill(signal.SIGTERM)
+            socketio.start_background_task(force_kill_after, sid, child_process, 0.5)
         except Exception as e:
-            print(f"Error terminating process for SID {sid}: {str(e)}")
-    leave_room(sid) # Client leaves their room
+            logger.error(f"Error terminating process for SID {sid}: {str(e)}")
 
 @socketio.on('start_download')
 def handle_start_download(data_dict):
     sid = request.sid
-    if sid in child_processes and child_processes[sid].isalive():
+    running = child_processes.get(sid) # Single lookup: a weak entry can vanish between two
+    if sid in starting_sids or (running is not None and running.isalive()):
         emit('error_message', {'error': 'A download process is already running for your session.'}, room=sid)
         return
 
@@ -109,53 +231,53 @@ def handle_start_download(data_dict):
         emit('error_message', {'error': 'No Apple Music URL provided.'}, room=sid)
         return
 
+    if not gamdl_slots.acquire(blocking=False):
+        emit('error_message', {'error': 'Server at capacity, retry shortly.'}, room=sid)
+        return
+    reader_started = False # Once the reader runs, it owns the slot and releases it when done
+
+    starting_sids.add(sid) # Claim the session before yielding, so a second request is rejected
     try:
-        gamdl_command_args = [
-            '--cookies-path', GAMDL_COOKIES_PATH,
-            '--output-path', GAMDL_OUTPUT_PATH,
-            '--mp4decrypt-path', '/usr/local/bin/mp4decrypt', # Path for Bento4 built from source
-            apple_music_url
-        ]
+        gamdl_command_args = [*GAMDL_BASE_ARGS, apple_music_url]
         
-        print(f"Starting gamdl for SID {sid} with command: gamdl {' '.join(gamdl_command_args)}")
+        logger.info(f"Starting gamdl for SID {sid} with command: gamdl {' '.join(gamdl_command_args)}")
         
-        # Set terminal dimensions and TERM environment variable for the pty
-        # This might help gamdl (or its underlying libraries) better detect terminal capabilities.
-        # Dimensions are (rows, cols).
-        dimensions = (24, 80) # A common default terminal size
-        env = os.environ.copy()
-        # Set TERM to xterm-256color, as Xterm.js emulates an xterm-compatible terminal.
-        # This provides a rich feature set for gamdl to use.
-        env['TERM'] = 'xterm-256color' 
-
         # echo=False prevents the pty from echoing input back, which we might otherwise read
-        child = pexpect.spawn('gamdl', 
-                              args=gamdl_command_args, 
-                              encoding='utf-8', 
-                              timeout=None, 
+        # The fork+exec runs in eventlet's native thread pool so it doesn't stall the event loop
+        # (and every other session's output) while the child starts.
+        # PtyProcess is bytes-only; output is forwarded to the client undecoded.
+        # No env is passed, so gamdl inherits the server's environment as-is, including TERM.
+        # The Docker image sets TERM=xterm-256color, as Xterm.js emulates an xterm-compatible
+        # terminal; started any other way, gamdl gets whatever TERM the server has (if any).
+        child = tpool.execute(PtyProcess.spawn,
+                              ['gamdl', *gamdl_command_args],
                               echo=False, 
-                              dimensions=dimensions,
-                              env=env)
+                              dimensions=GAMDL_DIMENSIONS)
+        if sid not in starting_sids:
+            # The client disconnected while we were spawning; nobody is left to read the output.
+            logger.info(f"SID {sid} disconnected during startup, terminating its gamdl process.")
+            child.close(force=True)
+            return
         child_processes[sid] = child
 
-        thread = threading.Thread(target=read_gamdl_output, args=(sid, child))
-        thread.daemon = True # Allows main program to exit even if threads are running
-        thread.start()
+        # The reader is a green thread that waits on the pty fd in the event loop.
+        socketio.start_background_task(read_gamdl_output, sid, child)
+        reader_started = True
         
         emit('info_message', {'message': f'gamdl process started for {apple_music_url}. Waiting for output...'}, room=sid)
 
-    except pexpect.exceptions.ExceptionPexpect as e:
+    except OSError as e: # Raised by PtyProcess.spawn if gamdl is missing or fails to exec
         error_msg = f"Failed to start gamdl: {str(e)}. Ensure 'gamdl' is installed and in your system's PATH."
-        print(error_msg)
+        logger.error(error_msg)
         emit('error_message', {'error': error_msg}, room=sid)
-        if sid in child_processes: # Clean up if spawn failed but entry was made
-            del child_processes[sid]
     except Exception as e:
         error_msg = f"An unexpected error occurred while trying to start gamdl: {str(e)}"
-        print(error_msg)
+        logger.error(error_msg)
         emit('error_message', {'error': error_msg}, room=sid)
-        if sid in child_processes: # Clean up
-            del child_processes[sid]
+    finally:
+        starting_sids.discard(sid)
+        if not reader_started:
+            gamdl_slots.release()
 
 @socketio.on('send_input')
 def handle_send_input(data_dict):
@@ -163,28 +285,41 @@ def handle_send_input(data_dict):
     user_input = data_dict.get('input') # Input can be an empty string
 
     if user_input is None: 
-        print(f"Received None input from SID {sid}, not sending.")
+        logger.info(f"Received None input from SID {sid}, not sending.")
         return
 
 
     child_process = child_processes.get(sid)
     if child_process and child_process.isalive():
         try:
-            print(f"Sending input to gamdl for SID {sid}: '{user_input}'")
-            # Use send() instead of sendline() to send raw input, including control characters,
-            # without automatically appending a newline. Xterm.js will send Enter as \r.
-            child_process.send(user_input) 
+            logger.info(f"Sending input to gamdl for SID {sid}: '{user_input}'")
+            # Write the raw input, including control characters, without appending a newline.
+            # Xterm.js will send Enter as \r.
+            input_bytes = user_input.encode('utf-8')
+            # The pty fd is non-blocking (see read_gamdl_output), so a full input buffer means
+            # a short write or none at all rather than waiting for gamdl to catch up.
+            try:
+                written = child_process.write(input_bytes) or 0
+            except BlockingIOError as e:
+                written = e.characters_written
+            if written < len(input_bytes):
+                if written:
+                    error_msg = f"gamdl is not reading input fast enough; only {written} of {len(input_bytes)} bytes were sent."
+                else:
+                    error_msg = "gamdl is not reading input fast enough; input was dropped."
+                logger.error(f"{error_msg} (SID {sid})")
+                emit('error_message', {'error': error_msg}, room=sid)
         except Exception as e:
             error_msg = f"Error sending input to gamdl for SID {sid}: {str(e)}"
-            print(error_msg)
+            logger.error(error_msg)
             emit('error_message', {'error': error_msg}, room=sid)
     else:
         # It's possible the process ended just before input was sent
         emit('info_message', {'message': 'No active gamdl process for your session, or process has ended. Input not sent.'}, room=sid)
-        print(f"No active process for SID {sid} to send input '{user_input}' to.")
+        logger.info(f"No active process for SID {sid} to send input '{user_input}' to.")
 
 # The following block is for running with the Flask development server.
-# In production, a WSGI server like Gunicorn will be used, as configured in the Dockerfile.
+# In production, a WSGI server like Gunicorn will be used, as configured in gunicorn.conf.py.
 # if __name__ == '__main__':
 #     if not os.path.exists('templates'):
 #         os.makedirs('templates')
@@ -0,0 +1,15 @@
+# Gunicorn configuration, picked up automatically when gunicorn is started from this directory:
+#   gunicorn app:app
+import os
+
+bind = "0.0.0.0:5000" # docker-compose.yml maps this to the host
+
+# app.py runs Flask-SocketIO in eventlet mode, so the worker must be eventlet too.
+# One worker serves thousands of WebSocket clients on its event loop.
+worker_class = "eventlet"
+worker_connections = 2000
+
+# Each worker keeps its own gamdl processes in memory, and Socket.IO needs every request from a
+# client to reach the same worker. Gunicorn can't do sticky sessions, so only raise this behind a
+# load balancer that pins clients to a worker (e.g. one instance per port behind nginx ip_hash).
+workers = int(os.environ.get("GUNICORN_WORKERS", "1"))